@@ -10,13 +10,16 @@ See:
 
 # Always prefer setuptools over distutils
 from setuptools import setup
-import re
 import os
 
 def get_version():
-    VERSION_RE = re.compile(r'''VERSION\s+=\s+['"]([0-9.]+)['"]''')
-    init = open(os.path.join(os.path.dirname(__file__), 'wmt.py')).read()
-    return VERSION_RE.search(init).group(1)
+    # The VERSION line is simple enough to find without the regex engine,
+    # and scanning line-by-line avoids reading the whole file.
+    with open(os.path.join(os.path.dirname(__file__), 'wmt.py')) as f:
+        for line in f:
+            if line.startswith('VERSION'):
+                return line.split('=', 1)[1].strip().strip('\'"')
+    raise RuntimeError('could not find VERSION in wmt.py')
 
 setup(
     name = 'wmt',
@@ -72,13 +75,13 @@ setup(
     # your project is installed. For an analysis of "install_requires" vs pip's
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
-    install_requires = ['typing', 'bs4'],
+    install_requires = ['typing', 'lxml', 'requests'],
 
     # List additional groups of dependencies here (e.g. development
     # dependencies). You can install these using the following syntax,
     # for example:
     # $ pip install -e .[dev,test]
-    extras_require = {},
+    extras_require = {'fast': ['html5-parser']},
 
     # To provide executable scripts, use entry points in preference to the
     # "scripts" keyword. Entry points provide cross-platform support and allow
@@ -24,16 +24,32 @@ import re
 import os
 import sys
 import csv
-import math
 import gzip
+import shutil
+import functools
 import tarfile
 import logging
-import urllib.request
 import urllib.parse
 import argparse
+import concurrent.futures
+
+import requests
+import requests.adapters
+
+from lxml import etree
+
+try:
+    # Optional fast path (pip install wmt[fast]): html5-parser builds the
+    # lxml tree entirely in C. It raises RuntimeError when its libxml2
+    # does not match lxml's (common with binary lxml wheels), in which
+    # case we fall back just as if it were not installed.
+    import html5_parser
+except (ImportError, RuntimeError):
+    html5_parser = None
 
 from collections import Counter, namedtuple
-from typing import List
+from types import MappingProxyType
+from typing import Tuple
 
 try:
     # SIGPIPE is not available on Windows machines, throwing an exception.
@@ -61,13 +77,27 @@ WMT = os.environ.get('WMT', os.path.join(USERHOME, '.wmt'))
 # n-gram order. Don't change this.
 NGRAM_ORDER = 4
 
+# Compiled once at module load: cells usually wrap their text in a <p>,
+# so prefer that, falling back to the cell's own normalized text.
+# normalize-space subsumes the whitespace stripping.
+_LEAF_XPATH = etree.XPath('normalize-space(string(./p[1]))')
+_TEXT_XPATH = etree.XPath('normalize-space()')
+
+# Shared HTTP session so that downloading all the langpairs of a test set
+# reuses pooled keep-alive connections to matrix.statmt.org instead of
+# paying a TCP handshake per page.
+_SESSION = requests.Session()
+_SESSION.mount('http://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=3))
+_SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=3))
+
 # This defines data locations.
 # At the top level are test sets.
 # Beneath each test set, we define the location to download the test data.
 # The other keys are each language pair contained in the tarball, and the respective locations of the source and reference data within each.
 # Many of these are *.sgm files, which are processed to produced plain text that can be used by this script.
 # The canonical location of unpacked, processed data is $SACREBLEU/$TEST/$SOURCE-$TARGET.{$SOURCE,$TARGET}
-data = {
+# The mapping is read-only; the proxy keeps it that way.
+data = MappingProxyType({
     'wmt19': {
         'description': 'Official results for WMT19.',
         'en-cs': 'http://matrix.statmt.org/matrix/systems_list/1896',
@@ -111,7 +141,7 @@ data = {
         'description': 'Official evaluation data for WMT 2016.',
         'en-cs': 'http://matrix.statmt.org/matrix/systems_list/1844',
     },
-}
+})
 
 
 def _read(file, encoding='utf-8'):
@@ -131,35 +161,74 @@ def process_to_csv(rawfile, txtfile):
     :param txtfile: the plaintext CSV file
     """
 
-    from bs4 import BeautifulSoup
-    soup = BeautifulSoup(open(rawfile), 'html.parser')
-
-    table = soup.find('table')
-    rows = table.find_all('tr')
+    # Raw pages are stored gzipped; open in binary so the parser does its
+    # own decoding.
+    opener = gzip.open if rawfile.endswith('.gz') else open
+    rows = []
+    if html5_parser is not None:
+        with opener(rawfile, 'rb') as fh:
+            # 'lxml_html' yields HtmlElement nodes, matching what the
+            # XPath extraction below expects.
+            root = html5_parser.parse(fh.read(), treebuilder='lxml_html')
+        rows = root.xpath('.//table[1]//tr')
+    else:
+        # Only the first <table> matters, so parse the document as a
+        # stream and stop as soon as that table closes, rather than
+        # building a tree for all the surrounding boilerplate.
+        with opener(rawfile, 'rb') as fh:
+            for _, elem in etree.iterparse(fh, events=('end',), tag=('tr', 'table'), html=True):
+                if elem.tag == 'table':
+                    break
+                rows.append(elem)
 
     logging.info("Processing {} to {}".format(rawfile, txtfile))
-    headers = [x.find(text=True) for x in rows[0].find_all('th')]
-    with open(txtfile, 'w') as csvfile:
-        out = csv.DictWriter(csvfile, fieldnames=headers)
-        out.writeheader()
-
-        def leaf(node):
-            text = None
-            if len(node.find_all('p')) == 1:
-                text = node.find('p').find(text=True)
+    headers = [''.join(th.itertext()).strip() for th in rows[0].xpath('./th')]
+    # A large write buffer keeps row writes from turning into many small
+    # syscalls; newline='' is the csv-module-recommended setting.
+    with open(txtfile, 'w', buffering=1 << 20, newline='') as csvfile:
+        # The typical score cell never needs quoting, so join fields by
+        # hand and skip the csv module's per-field quoting machinery;
+        # rows with fields that need quoting (commas, quotes, newlines)
+        # fall back to csv.writer, which preserves them verbatim.
+        fallback = csv.writer(csvfile)
+
+        def writerow(values):
+            if any('"' in v or ',' in v or '\n' in v or '\r' in v for v in values):
+                fallback.writerow(values)
             else:
-                text = node.find(text=True)
-            return text.rstrip() if text is not None else ''
+                csvfile.write(','.join(values) + '\n')
 
+        writerow(headers)
         for row in rows[1:]:
-            values = [leaf(x) for x in row.find_all('td')]
+            values = [_LEAF_XPATH(x) or _TEXT_XPATH(x) for x in row.xpath('./td')]
             if len(headers) == len(values):
-                out.writerow(dict(zip(headers, values)))
-                # print(values)
+                writerow(values)
+
+
+def _iter_rows(csvfile):
+    """Lazily yields rows from a processed CSV file, closing the file
+    handle when exhausted.
+
+    :param csvfile: the CSV file to read
+    :return: a generator over row dicts
+    """
+    with open(csvfile, newline='') as fh:
+        yield from csv.DictReader(fh)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_csv(csvfile):
+    """Reads a processed CSV file, memoizing the rows so repeated calls
+    for the same file skip the disk read and parse.
+
+    :param csvfile: the CSV file to read
+    :return: a tuple of row dicts
+    """
+    return tuple(_iter_rows(csvfile))
 
 
 def download_matrix_page(test_set: str,
-                         langpair = None) -> List[csv.OrderedDict]:
+                         langpair = None) -> Tuple[dict, ...]:
     """Downloads the specified matrix page to the system location specified by the WMT environment variable.
 
     :param page: the test set to download
@@ -170,22 +239,33 @@ def download_matrix_page(test_set: str,
     #     return None
 
     if langpair is None:
-        for langpair in data[test_set].keys():
-            download_matrix_page(test_set, langpair)
+        # The per-langpair GETs are independent and latency-bound, so
+        # fetch them concurrently over the shared keep-alive session.
+        langpairs = filter(lambda x: '-' in x, data[test_set].keys())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as ex:
+            list(ex.map(lambda lp: download_matrix_page(test_set, lp), langpairs))
     else:
         dataset = data[test_set][langpair]
         outdir = os.path.join(WMT, test_set)
         rawdir = os.path.join(outdir, 'raw')
-        if not os.path.exists(rawdir):
-            logging.info('Creating {}'.format(rawdir))
-            os.makedirs(rawdir)
+        os.makedirs(rawdir, exist_ok=True)
 
-        htmlpage = os.path.join(rawdir, os.path.basename(dataset))
+        # Matrix pages are highly compressible HTML, so cache them gzipped.
+        htmlpage = os.path.join(rawdir, os.path.basename(dataset) + '.gz')
         if not os.path.exists(htmlpage):
             # TODO: check MD5sum
             logging.info("Downloading {} to {}".format(dataset, htmlpage))
-            with urllib.request.urlopen(dataset) as f, open(htmlpage, 'wb') as out:
-                out.write(f.read())
+            # Stream in 1 MiB chunks rather than buffering the whole
+            # response in memory before writing.
+            with _SESSION.get(dataset, stream=True, timeout=30) as r:
+                # Fail before the cache file exists; otherwise an HTTP
+                # error leaves an empty page that later runs trust.
+                r.raise_for_status()
+                # r.raw yields the transport bytes as-is; have urllib3
+                # undo any Content-Encoding the server applied.
+                r.raw.decode_content = True
+                with gzip.open(htmlpage, 'wb', compresslevel=6) as out:
+                    shutil.copyfileobj(r.raw, out, length=1 << 20)
 
         csvfile = os.path.join(outdir, '{}.{}.csv'.format(test_set, langpair))
         if not os.path.exists(csvfile):
@@ -194,7 +274,7 @@ def download_matrix_page(test_set: str,
             # BLEU = namedtuple('BLEU', 'score, counts, totals, precisions, bp, sys_len, ref_len')
             # return [ENTRY._make([, correct, total, precisions, brevity_penalty, sys_len, ref_len] for x in csv.DictReader(open(csvfile)))]
 
-        return [x for x in csv.DictReader(open(csvfile))]
+        return _load_csv(csvfile)
 
 
 def main():
@@ -222,6 +302,11 @@ def main():
                             version='%(prog)s {}'.format(VERSION))
     args = arg_parser.parse_args()
 
+    # Intern the keys probed repeatedly against `data` below so the dict
+    # lookups can compare by identity.
+    args.test_set = sys.intern(args.test_set) if args.test_set else None
+    args.langpair = sys.intern(args.langpair) if args.langpair else None
+
     if not args.quiet:
         logging.basicConfig(level=logging.INFO, format='WMT: %(message)s')
 
@@ -230,9 +315,10 @@ def main():
         sys.exit(0)
 
     if args.test_set is not None and args.test_set not in data:
-        logging.error('The available test sets are: ')
-        for ts in sorted(data.keys(), reverse=True):
-            logging.error('  {}: {}'.format(ts, data[ts].get('description', '')))
+        # One formatted message means one trip through the log handler.
+        logging.error('The available test sets are:\n' + '\n'.join(
+            '  {}: {}'.format(ts, data[ts].get('description', ''))
+            for ts in sorted(data.keys(), reverse=True)))
         sys.exit(1)
 
     if args.test_set and (args.langpair is None or args.langpair not in data[args.test_set]):
@@ -245,26 +331,22 @@ def main():
 
     if args.test_set:
         d = download_matrix_page(args.test_set, args.langpair)
-        i = 0
-
-        def get_value(value):
-            if value == 'failed':
-                return -math.inf
-            return float(value)
-
-        for row in sorted(d, key=lambda x: get_value(x['BLEU-cased']), reverse=True):
-            if row['BLEU-cased'] == 'failed':
-                continue
-            if not args.constrained or row['Constraint'] == 'yes':
-                i += 1
-                if args.top_k == 0 or i <= args.top_k:
-                    if args.score_only:
-                        print(row['BLEU-cased'])
-                    else:
-                        print(row['System'], row['BLEU-cased'], sep='\t')
-                    if args.description:
-                        print(row['System Notes'])
-                        print('--')
+
+        # Filter failed/unwanted rows first so the sort runs on a smaller
+        # list, and sort on float scores rather than their string forms.
+        rows = [row for row in d
+                if row['BLEU-cased'] != 'failed'
+                and (not args.constrained or row['Constraint'] == 'yes')]
+        rows.sort(key=lambda row: float(row['BLEU-cased']), reverse=True)
+
+        for row in rows[:args.top_k or None]:
+            if args.score_only:
+                print(row['BLEU-cased'])
+            else:
+                print(row['System'], row['BLEU-cased'], sep='\t')
+            if args.description:
+                print(row['System Notes'])
+                print('--')
 
 
 if __name__ == '__main__':